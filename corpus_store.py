@@ -0,0 +1,251 @@
+"""
+    Copyright 2015, Berit Janssen.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import struct
+import numpy as np
+
+MAGIC = b'MELOCC1\n'
+# the data starts at a multiple of this number of bytes
+ALIGNMENT = 64
+
+# the stores opened by open_store in this process, per path
+_open_stores = {}
+
+class SymbolColumns(object):
+    """ the symbols of a melody or segment, stored as one array per
+    music representation, e.g. slices of a memory-mapped corpus store.
+    Can be used instead of the list of symbol dicts produced by
+    music_representations.extract_melodies_from_corpus:
+    indexing and iteration return symbol dicts, and curve returns
+    the values of one music representation without creating them.
+    Undefined values (None) are stored as nan in nullable columns.
+    Symbols read from a corpus store keep its path and their rows as source,
+    so that other processes can open them from the store (cf. open_store).
+    """
+    def __init__(self, columns, integer_columns=(), nullable_columns=(),
+     source=None):
+        self.columns = columns
+        self.integer_columns = set(integer_columns)
+        self.nullable_columns = set(nullable_columns)
+        self.source = source
+
+    def __len__(self):
+        return len(next(iter(self.columns.values())))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            source = None
+            if self.source and index.step in (None, 1):
+                start, stop, step = index.indices(len(self))
+                source = (self.source[0], self.source[1] + start,
+                 self.source[1] + max(start, stop))
+            return SymbolColumns({k: v[index] for k,v in
+             self.columns.items()}, self.integer_columns,
+             self.nullable_columns, source)
+        if index < 0:
+            index += len(self)
+        return {k: self.to_python(k, v[index:index + 1].tolist())[0] for k,v
+         in self.columns.items()}
+
+    def __iter__(self):
+        curves = {k: self.curve(k) for k in self.columns}
+        for i in range(len(self)):
+            yield {k: curves[k][i] for k in curves}
+
+    def __getstate__(self):
+        # pickle arrays, not memory maps
+        return {'columns': {k: np.array(v) for k,v in self.columns.items()},
+         'integer_columns': self.integer_columns,
+         'nullable_columns': self.nullable_columns,
+         'source': self.source}
+
+    def column(self, music_representation):
+        """ returns the array of one music representation """
+        return self.columns[music_representation]
+
+    def curve(self, music_representation):
+        """ returns the values of one music representation as a list,
+        as [s[music_representation] for s in symbols] would """
+        return self.to_python(music_representation,
+         self.columns[music_representation].tolist())
+
+    def to_python(self, music_representation, values):
+        if music_representation in self.nullable_columns:
+            values = [None if v!=v else v for v in values]
+        if music_representation in self.integer_columns:
+            values = [v if v is None else int(v) for v in values]
+        return values
+
+def as_symbol_columns(symbols):
+    """ returns the symbols of a melody or segment as SymbolColumns,
+    converting a list of symbol dicts column by column """
+    if isinstance(symbols, SymbolColumns):
+        return symbols
+    columns = {}
+    integer_columns = []
+    nullable_columns = []
+    for c in symbols[0]:
+        columns[c], is_integer, is_nullable = column_from_values(
+         [s[c] for s in symbols])
+        if is_integer:
+            integer_columns.append(c)
+        if is_nullable:
+            nullable_columns.append(c)
+    return SymbolColumns(columns, integer_columns, nullable_columns)
+
+def column_from_values(values):
+    """ takes the values of one music representation, returns them as a
+    float array, with None as nan, and whether all values are integers,
+    and whether some are None """
+    defined = [v for v in values if v is not None]
+    is_integer = all(isinstance(v, (int, np.integer)) and
+     not isinstance(v, bool) for v in defined)
+    column = np.array([np.nan if v is None else float(v) for v in values])
+    return column, is_integer, len(defined) < len(values)
+
+class CorpusStore(object):
+    """ a corpus written by write_corpus_store, opened memory-mapped.
+    The melodies and segments it returns are views on the pages of the file.
+    Processes which open the same store (cf. open_store) share these pages,
+    but melodies and segments passed to another process are pickled as
+    copies of their symbols: worker processes should open the store
+    from its path instead. A CorpusStore is pickled as its path.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC))!=MAGIC:
+                raise ValueError('%s is not a corpus store' % path)
+            header_length = struct.unpack('<Q', f.read(8))[0]
+            self.header = json.loads(f.read(header_length).decode('utf-8'))
+        columns = self.header['columns']
+        self.data = np.memmap(path, dtype='<f8', mode='r',
+         offset=self.header['data_offset'],
+         shape=(len(columns), self.header['num_symbols']))
+        self.column_index = {c: i for i,c in enumerate(columns)}
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def symbols(self, start, stop):
+        """ returns the symbols stored in rows start to stop """
+        return SymbolColumns({c: self.data[i, start:stop] for c,i in
+         self.column_index.items()}, self.header['integer_columns'],
+         self.header['nullable_columns'], (self.path, start, stop))
+
+    def tunefamily_ids(self):
+        return sorted(set([m['tunefamily_id'] for m in
+         self.header['melodies']]))
+
+    def melodies(self, tunefamily_id=None):
+        """ returns the melodies, optionally of one tune family, in the
+        format of music_representations.extract_melodies_from_corpus """
+        melody_list = []
+        for m in self.header['melodies']:
+            if tunefamily_id is not None and m['tunefamily_id']!=tunefamily_id:
+                continue
+            melody = {k: m[k] for k in m if
+             k not in ('start', 'stop', 'phrases')}
+            melody['symbols'] = self.symbols(m['start'], m['stop'])
+            melody_list.append(melody)
+        return melody_list
+
+    def segments(self, tunefamily_id=None):
+        """ returns the phrases of the melodies, optionally of one tune
+        family, in the format of music_representations.filter_phrases """
+        segment_list = []
+        for m in self.header['melodies']:
+            if tunefamily_id is not None and m['tunefamily_id']!=tunefamily_id:
+                continue
+            for segment_id, start, stop in m['phrases']:
+                entry = {'tunefamily_id': m['tunefamily_id'],
+                 'filename': m['filename'],
+                 'segment_id': segment_id,
+                 'symbols': self.symbols(start, stop)}
+                if 'onsets_multiplied_by' in m:
+                    entry['onsets_multiplied_by'] = m['onsets_multiplied_by']
+                segment_list.append(entry)
+        return segment_list
+
+def open_store(path):
+    """ returns the CorpusStore at path, opened once per process:
+    to be called in worker processes, e.g. in the initializer of a pool,
+    as open_store(path).melodies(tunefamily_id) """
+    if path not in _open_stores:
+        _open_stores[path] = CorpusStore(path)
+    return _open_stores[path]
+
+def write_corpus_store(melody_list, path):
+    """ takes a list of melodies, as produced by
+    music_representations.extract_melodies_from_corpus, and writes the
+    values of their symbols to one file, column by column, with a table of
+    the rows in which each melody and each of its phrases is stored.
+    Onsets are stored as floats.
+    """
+    columns = sorted(melody_list[0]['symbols'][0].keys())
+    num_symbols = sum([len(m['symbols']) for m in melody_list])
+    data = np.empty((len(columns), num_symbols))
+    integer_columns = []
+    nullable_columns = []
+    for i, c in enumerate(columns):
+        values = [s[c] for m in melody_list for s in m['symbols']]
+        data[i], is_integer, is_nullable = column_from_values(values)
+        if is_integer:
+            integer_columns.append(c)
+        if is_nullable:
+            nullable_columns.append(c)
+    melodies = []
+    start = 0
+    for m in melody_list:
+        entry = {k: m[k] for k in m if k!='symbols'}
+        stop = start + len(m['symbols'])
+        entry['start'] = start
+        entry['stop'] = stop
+        entry['phrases'] = []
+        if 'phrase_id' in columns:
+            # phrases are consecutive runs of symbols with the same phrase_id
+            phrase_ids = [s['phrase_id'] for s in m['symbols']]
+            phrase_start = 0
+            for j in range(1, len(phrase_ids) + 1):
+                if j==len(phrase_ids) or phrase_ids[j]!=phrase_ids[j-1]:
+                    entry['phrases'].append((phrase_ids[j-1],
+                     start + phrase_start, start + j))
+                    phrase_start = j
+        melodies.append(entry)
+        start = stop
+    header = {'columns': columns, 'num_symbols': num_symbols,
+     'integer_columns': integer_columns,
+     'nullable_columns': nullable_columns,
+     'melodies': melodies, 'data_offset': 0}
+    # the data offset is part of the header: find a stable value
+    while True:
+        encoded = json.dumps(header).encode('utf-8')
+        data_offset = len(MAGIC) + 8 + len(encoded)
+        data_offset += -data_offset % ALIGNMENT
+        if data_offset==header['data_offset']:
+            break
+        header['data_offset'] = data_offset
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(encoded)))
+        f.write(encoded)
+        f.write(b'\0' * (data_offset - len(MAGIC) - 8 - len(encoded)))
+        f.write(data.astype('<f8').tobytes())
@@ -16,9 +16,15 @@
 """
 
 import similarity as sim
+import input_output as io
+import prefilter as pf
 import numpy as np
+import hashlib
+import json
+import os
 import time
 from collections import Counter
+from urllib.parse import quote
 
 def distance_measures(melody_list,segment_list,
   music_representation,return_positions,scaling):
@@ -33,7 +39,7 @@ def distance_measures(melody_list,segment_list,
     result_list = []
     keys = ['cbd','ed','cd']
     for seg in segment_list:
-        segment_curve = [a[music_representation] for a in seg['symbols']]
+        segment_curve = get_curve(seg['symbols'], music_representation)
         if segment_curve[0] is None:
             # checking if first note has an undefined value, 
             # e.g. pitch interval
@@ -42,7 +48,7 @@ def distance_measures(melody_list,segment_list,
         for mel in melody_list: 
             result_dict = {}
             matches = []
-            mel_curve = [a[music_representation] for a in mel['symbols']]
+            mel_curve = get_curve(mel['symbols'], music_representation)
             if mel_curve[0] is None:
                 # if the first value (e.g. pitch interval, ioi) 
                 #is undefined, discard it
@@ -86,6 +92,106 @@ def distance_measures(melody_list,segment_list,
             'matches':result_dict})
     return result_list
 
+def best_match_distances(melody_list, segment_list,
+  music_representation, return_positions, scaling):
+    """ this function finds the same best matches as distance_measures, 
+    for city-block and euclidean distance (not correlation distance),
+    but does not compute the distance of every window of a melody:
+    windows are visited in the order of a lower bound of their distance, 
+    and skipped or abandoned as soon as they cannot be the best match
+    (cf. best_windows).
+    """
+    result_list = []
+    keys = [('cbd', sim.city_block_distance, False),
+     ('ed', sim.euclidean_distance, True)]
+    for seg in segment_list:
+        segment_curve = get_curve(seg['symbols'], music_representation)
+        if segment_curve[0] is None:
+            segment_curve = segment_curve[1:]
+        query_length = len(segment_curve)
+        for mel in melody_list: 
+            result_dict = {}
+            mel_curve = get_curve(mel['symbols'], music_representation)
+            if mel_curve[0] is None:
+                mel_curve = mel_curve[1:]
+            # for duration weighed sequences,
+            # query sequences might be longer than a melody sequence
+            this_segment_curve = segment_curve[0:len(mel_curve)]
+            for k, distance, euclidean in keys:
+                best_similarity, best_match_indices = best_windows(
+                 this_segment_curve, mel_curve, distance, euclidean)
+                match_list = []
+                for b in best_match_indices:
+                    match_stats = {'similarity': best_similarity} 
+                    if return_positions:
+                        match_start_onset, match_end_onset = find_positions( 
+                         mel, b, query_length-1, scaling)
+                        match_stats['match_start_onset'] = match_start_onset
+                        match_stats['match_end_onset'] = match_end_onset
+                    match_list.append(match_stats)
+                result_dict[k] = match_list 
+            result_list.append({'tunefamily_id':seg['tunefamily_id'],
+            'query_filename':seg['filename'],
+            'match_filename':mel['filename'],
+            'query_segment_id':seg['segment_id'],
+            'query_length':query_length,
+            'matches':result_dict})
+    return result_list
+
+def best_windows(segment_curve, mel_curve, distance, euclidean, block=8):
+    """ returns the smallest distance between the segment curve and the 
+    windows of the melody curve, and the indices of all windows with that 
+    distance, as distance_measures would find them.
+    The distance of a window is at least the difference between the sums of 
+    segment and window (divided by the square root of the query length 
+    for euclidean distance), computed for all windows from cumulative sums.
+    Windows are visited in the order of this lower bound, until it exceeds 
+    the best distance so far; the sum of a window's differences is computed 
+    per block and abandoned as soon as it exceeds the best distance.
+    The distance of the remaining windows is computed by the distance 
+    function, so ties are the same as in distance_measures. 
+    """
+    n = len(segment_curve)
+    query = np.array(segment_curve, dtype=float)
+    curve = np.array(mel_curve, dtype=float)
+    sums = np.concatenate(([0.0], np.cumsum(curve)))
+    lower_bounds = np.abs(query.sum() - (sums[n:] - sums[:-n]))
+    if euclidean:
+        lower_bounds /= np.sqrt(n)
+    # margin for rounding errors of the bounds and partial sums
+    tolerance = 1e-9 * (np.abs(query).sum() + np.abs(curve).sum() + 1.0)
+    # best distance so far, not normalized by the query length
+    best_total = np.inf
+    values = {}
+    for l in np.argsort(lower_bounds, kind='stable'):
+        threshold = best_total * (1.0 + 1e-9) + tolerance
+        if lower_bounds[l] > threshold:
+            # the remaining windows have larger lower bounds
+            break
+        partial = 0.0
+        for start in range(0, n, block):
+            stop = min(start + block, n)
+            differences = query[start:stop] - curve[l+start:l+stop]
+            if euclidean:
+                partial += np.dot(differences, differences)
+                abandon = partial > threshold**2
+            else:
+                partial += np.abs(differences).sum()
+                abandon = partial > threshold
+            if abandon:
+                break
+        else:
+            value = distance(segment_curve, mel_curve[l:l+n])
+            values[l] = value
+            if value * n < best_total:
+                best_total = value * n
+    defined = [v for v in values.values() if not np.isnan(v)]
+    if not defined:
+        return np.nan, []
+    best_similarity = min(defined)
+    return best_similarity, sorted([l for l in values if 
+     values[l]==best_similarity])
+
 def find_positions(melody_dict, match_index, query_length, scaling):
     if not scaling:
         match_start_onset = melody_dict['symbols'][match_index]['onset']
@@ -101,6 +207,14 @@ def find_positions(melody_dict, match_index, query_length, scaling):
              float(melody_dict['onsets_multiplied_by']))
     return match_start_onset, match_end_onset
 
+def get_curve(symbols, music_representation):
+    """ returns the values of the symbols of a melody or segment
+    in the specified music representation. The symbols are a list of 
+    dictionaries, or a corpus_store.SymbolColumns """
+    if hasattr(symbols, 'curve'):
+        return symbols.curve(music_representation)
+    return [a[music_representation] for a in symbols]
+
 def local_aligner(melody_list, segment_list,
  music_representation, return_positions, scaling, insertion_weight=-.5,
  deletion_weight=-.5, substitution_function=sim.pitch_rater, variances=[]):
@@ -119,14 +233,14 @@ def local_aligner(melody_list, segment_list,
 	"""
     result_list = []
     for seg in segment_list: 
-        segment_curve = [a[music_representation] for a in seg['symbols']]
+        segment_curve = get_curve(seg['symbols'], music_representation)
         query_length = len(segment_curve)
         if segment_curve[0] is None: 
 		    # if the first value (e.g. pitch interval, ioi) 
             #is undefined, discard it
             segment_curve = segment_curve[1:]
         for mel in melody_list: 
-            mel_curve = [a[music_representation] for a in mel['symbols']]
+            mel_curve = get_curve(mel['symbols'], music_representation)
             if mel_curve[0] is None:
 			    # if the first value (e.g. pitch interval, ioi) 
                 #is undefined, discard it
@@ -165,14 +279,14 @@ def SIAM(melody_list,segment_list,music_representation,
 	"""
     result_list = []
     for seg in segment_list :
-        start_onset = seg['symbols'][0]['onset']
-        seg_points = [(s['onset'] - start_onset, s['pitch']) for 
-         s in seg['symbols']]
+        seg_onsets = get_curve(seg['symbols'], 'onset')
+        seg_points = [(o - seg_onsets[0], p) for o, p in 
+         zip(seg_onsets, get_curve(seg['symbols'], 'pitch'))]
         for mel in melody_list: 
             translation_vectors = []
             translation_vectors_with_position = []
-            mel_points = np.array([(s['onset'], s['pitch']) for 
-             s in mel['symbols']])
+            mel_points = np.array(list(zip(get_curve(mel['symbols'], 'onset'),
+             get_curve(mel['symbols'], 'pitch'))))
             for p in seg_points: 
                 vectors = (mel_points - p)
                 translation_vectors.extend([tuple(v) for v in vectors])
@@ -210,7 +324,8 @@ def SIAM(melody_list,segment_list,music_representation,
 		
 def matches_in_corpus(all_melody_list, all_segment_list,
  music_representation='pitch', measure=local_aligner, return_positions=True, 
- scaling=None, *args):
+ scaling=None, *args, prefilter_k=None, prefilter_weights=(1.0, 1.0, 1.0),
+ run_dir=None):
     """ this function finds occurrences in a corpus. It takes a list of 
     all melodies and segments in a corpus, and finds occurrences in the 
     specified music representation with the specified similarity measure.
@@ -218,16 +333,98 @@ def matches_in_corpus(all_melody_list, all_segment_list,
     returned as well, at the expense of computation time.
     For duration weighted pitch sequences, the scaling factor indicates 
     the sampling of the pitch sequences, and makes it possible to recalculate 
-    the position in quarterLength (cf. music21). """
-    tick = time.clock()
+    the position in quarterLength (cf. music21).
+    If prefilter_k is given, each segment is only compared to its own 
+    melody and the prefilter_k other melodies of its tune family with the 
+    closest embeddings (cf. prefilter.nearest_melodies); 
+    prefilter.prefilter_recall compares the results to those of an 
+    exhaustive run.
+    If run_dir is given, the results of each tune family are written to 
+    the subdirectory families of run_dir as soon as they are finished, 
+    together with the configuration of the run and a fingerprint of the 
+    melodies and segments (cf. input_fingerprint). Running again with the 
+    same run_dir, configuration and input skips the tune families which are 
+    done. When all tune families are done, the merged results are written 
+    to run_dir as results.pickle. """
+    tick = time.perf_counter()
     all_results = []
-    tune_fams = set([m['tunefamily_id'] for m in all_melody_list])
+    tune_fams = sorted(set([m['tunefamily_id'] for m in all_melody_list]))
+    if run_dir:
+        prepare_run_dir(run_dir, {
+         'music_representation': music_representation,
+         'measure': measure.__name__, 'return_positions': return_positions,
+         'scaling': scaling, 'args': [config_value(a) for a in args],
+         'prefilter_k': prefilter_k, 
+         'prefilter_weights': list(prefilter_weights),
+         'input': input_fingerprint(all_melody_list, all_segment_list,
+          music_representation)})
     for fam in tune_fams :
+        if run_dir:
+            fam_path = os.path.join(run_dir, 'families', 
+             quote(str(fam), safe='') + '.pickle')
+            if os.path.exists(fam_path):
+                all_results.extend(io.load_pickle(fam_path))
+                continue
         segment_list = [s for s in all_segment_list if s['tunefamily_id']==fam]
         melody_list = [m for m in all_melody_list if m['tunefamily_id']==fam]
         print(fam, len(melody_list), len(segment_list))
-        fam_results = measure(melody_list, segment_list, music_representation, 
-         return_positions, scaling, *args)
+        if prefilter_k:
+            candidates = pf.nearest_melodies(segment_list, melody_list,
+             prefilter_k, prefilter_weights)
+            fam_results = []
+            for seg, candidate_list in zip(segment_list, candidates):
+                fam_results.extend(measure(candidate_list, [seg], 
+                 music_representation, return_positions, scaling, *args))
+        else:
+            fam_results = measure(melody_list, segment_list, 
+             music_representation, return_positions, scaling, *args)
+        if run_dir:
+            io.write_atomically(fam_results, fam_path)
         all_results.extend(fam_results)
-    print(time.clock()-tick)
-    return all_results
\ No newline at end of file
+    if run_dir:
+        io.write_atomically(all_results, os.path.join(run_dir, 
+         'results.pickle'))
+    print(time.perf_counter()-tick)
+    return all_results
+
+def config_value(arg):
+    """ returns an argument of matches_in_corpus as it is stored in the 
+    configuration of a run: functions, such as similarity measures, by 
+    their module and name, since their repr differs between processes, 
+    other arguments by their repr """
+    if callable(arg) and hasattr(arg, '__qualname__'):
+        return '%s.%s' % (arg.__module__, arg.__qualname__)
+    return repr(arg)
+
+def input_fingerprint(all_melody_list, all_segment_list, 
+ music_representation):
+    """ returns a hash of the melodies and segments of a run of 
+    matches_in_corpus, in their order: their tune families, filenames and 
+    segment ids, and the values of the music representation and of the 
+    onsets, so that a run is not resumed with e.g. other segments or 
+    melodies adjusted in a different way """
+    digest = hashlib.sha1()
+    for item in all_melody_list + all_segment_list:
+        digest.update(repr((item['tunefamily_id'], item['filename'], 
+         item.get('segment_id'))).encode('utf-8'))
+        for rep in (music_representation, 'onset'):
+            if rep in item['symbols'][0]:
+                digest.update(repr(get_curve(item['symbols'], 
+                 rep)).encode('utf-8'))
+    return digest.hexdigest()
+
+def prepare_run_dir(run_dir, config):
+    """ creates the directory for a checkpointed run of matches_in_corpus 
+    and writes the configuration of the run to it, or checks that an
+    existing run directory has the same configuration """
+    config_path = os.path.join(run_dir, 'config.json')
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            stored_config = json.load(f)
+        if stored_config != config:
+            raise ValueError('%s contains a run with a different '
+             'configuration: %s' % (run_dir, stored_config))
+        return
+    if not os.path.isdir(os.path.join(run_dir, 'families')):
+        os.makedirs(os.path.join(run_dir, 'families'))
+    io.write_atomically(config, config_path, as_json=True)
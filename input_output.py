@@ -16,6 +16,10 @@
 """
 
 import csv
+import json
+import os
+import pickle
+import tempfile
 
 def add_tunefamily_ids(in_dict,conversion_table_path):
     """ This function takes a list of dictionaries as produced by "csv_to_dict"
@@ -39,7 +43,7 @@ def csv_to_dict(doc, keys=None, deli=","):
     deli=delimiter to use (e.g. \t for tab)
     """
     dict_list = []
-    with open(doc, "rU") as f:
+    with open(doc, "r") as f:
         read = csv.DictReader(f, keys, delimiter=deli)
         for line in read:
             dict_list.append(line)
@@ -67,4 +71,29 @@ def save_for_R(evaluation_list, fname):
             for key in general_info:
                 p[key] = e[key]
         out_dict.extend(position_eval)
-    dict_to_csv(out_dict,list(out_dict[0].keys()), fname)
\ No newline at end of file
+    dict_to_csv(out_dict,list(out_dict[0].keys()), fname)
+
+def load_pickle(fname):
+    """ returns the object pickled in fname """
+    with open(fname, "rb") as f:
+        return pickle.load(f)
+
+def write_atomically(data, fname, as_json=False):
+    """ pickles data to fname, or writes it as json, via a temporary file 
+    in the same directory, so that fname is either complete or absent,
+    even if the process is killed while writing 
+    """
+    directory = os.path.dirname(os.path.abspath(fname))
+    handle, temp_name = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "w" if as_json else "wb") as f:
+            if as_json:
+                json.dump(data, f, indent=1, sort_keys=True)
+            else:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_name, fname)
+    except BaseException:
+        os.remove(temp_name)
+        raise
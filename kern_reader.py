@@ -0,0 +1,268 @@
+"""
+    Copyright 2015, Berit Janssen.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+from fractions import Fraction
+
+# characters for which music21 attaches an expression (fermata, trill,
+# mordent, turn, ornament) to a note or rest
+EXPRESSION_CHARACTERS = ';tTwWmMS$RO'
+STEPS = 'cdefgab'
+PITCH_CLASSES = [0, 2, 4, 5, 7, 9, 11]
+
+class UnsupportedKernError(ValueError):
+    """ raised for **kern files which read_kern_features cannot read,
+    such as files with several voices, chords or grace notes """
+
+def read_kern_features(path):
+    """ reads a monophonic **kern file, returns the same features of the
+    melody as music_representations.read_features_music21:
+    midi note numbers, diatonic note numbers, diatonic note number of the
+    tonic, onsets, duration of the last note, onsets of notes with fermatas
+    and metric weights (None if the melody has only one measure).
+    Tied notes are merged, as by music21's stripTies.
+    Files which are not utf-8 encoded are read as latin-1: non-ascii
+    characters only occur in comments. Any error in parsing the file
+    is raised as UnsupportedKernError.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        text = data.decode('latin-1')
+    try:
+        return parse_kern(text.splitlines())
+    except UnsupportedKernError:
+        raise
+    except (ValueError, LookupError, ZeroDivisionError) as e:
+        raise UnsupportedKernError('cannot parse %s: %r' % (path, e)) from e
+
+def parse_kern(lines):
+    """ takes the lines of a **kern file, returns the features of the melody
+    (cf. read_kern_features) """
+    kern_spine = None
+    num_spines = 0
+    offset = Fraction(0)
+    notes = []
+    phrase_ends = []
+    tonic = None
+    # per time signature: its offset, bar duration and accent levels
+    meters = []
+    num_measures = 0
+    measure_has_events = False
+    tie_open = False
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line or line.startswith('!'):
+            continue
+        tokens = line.split('\t')
+        if kern_spine is None:
+            if not line.startswith('**'):
+                continue
+            kern_spines = [i for i,t in enumerate(tokens) if t=='**kern']
+            if len(kern_spines)!=1:
+                raise UnsupportedKernError('%d **kern spines' %
+                 len(kern_spines))
+            kern_spine = kern_spines[0]
+            num_spines = len(tokens)
+            continue
+        if len(tokens)!=num_spines:
+            raise UnsupportedKernError('spines are split or joined')
+        token = tokens[kern_spine]
+        if token.startswith('*'):
+            if token == '*-':
+                break
+            if any(t in ('*^', '*v', '*+', '*x') for t in tokens):
+                raise UnsupportedKernError('spines are split or joined')
+            meter = re.match(r'\*M(\d+)/(\d+)$', token)
+            if meter:
+                numerator = int(meter.group(1))
+                bar = Fraction(4 * numerator, int(meter.group(2)))
+                meters.append((offset, bar, accent_levels(numerator)))
+            key = re.match(r'\*([a-gA-G])[#-]*:', token)
+            if key and tonic is None:
+                # music21 gives the tonic the implicit octave 4
+                tonic = 4 * 7 + STEPS.index(key.group(1).lower()) + 1
+            continue
+        if token.startswith('='):
+            if measure_has_events:
+                num_measures += 1
+                measure_has_events = False
+            continue
+        if token == '.':
+            continue
+        if ' ' in token:
+            raise UnsupportedKernError('chord %s' % token)
+        duration = parse_duration(token)
+        measure_has_events = True
+        if any(c in token for c in EXPRESSION_CHARACTERS):
+            phrase_ends.append(op_frac(offset))
+        name = re.search('[a-gA-G]+', token)
+        if not name:
+            if not 'r' in token:
+                raise UnsupportedKernError('cannot read %s' % token)
+            tie_open = False
+        elif '[' in token:
+            notes.append([name.group(0), token, offset, duration])
+            tie_open = True
+        elif ']' in token or '_' in token:
+            if not tie_open:
+                raise UnsupportedKernError('tie without start %s' % token)
+            notes[-1][3] += duration
+            tie_open = '_' in token and not ']' in token
+        else:
+            notes.append([name.group(0), token, offset, duration])
+            tie_open = False
+        offset += duration
+    if measure_has_events:
+        num_measures += 1
+    if not notes:
+        raise UnsupportedKernError('no notes')
+    if num_measures==1:
+        metric_weights = None
+    else:
+        if not meters or meters[0][0] > notes[0][2]:
+            raise UnsupportedKernError('no time signature')
+        metric_weights = [beat_strength(n[2], meters) for n in notes]
+    pitches = [pitch_numbers(n[0], n[1]) for n in notes]
+    return {'pitches': [p[0] for p in pitches],
+     'diatonic_note_nums': [p[1] for p in pitches],
+     'tonic': tonic,
+     'onsets': [op_frac(n[2]) for n in notes],
+     'last_duration': op_frac(notes[-1][3]),
+     'phrase_ends': phrase_ends,
+     'metric_weights': metric_weights}
+
+def accent_levels(numerator):
+    """ returns the number of parts into which the measure, and each of its
+    parts, are divided for the beat strengths of a meter,
+    as in music21's default accent weights """
+    if numerator % 3 == 0 and numerator > 3:
+        # compound meter: beats of three parts
+        beats, division = numerator // 3, [3]
+    else:
+        beats, division = numerator, []
+    if beats==1:
+        levels = []
+    elif beats==4:
+        levels = [2, 2]
+    elif beats in (2, 3, 5, 7):
+        levels = [beats]
+    else:
+        raise UnsupportedKernError('meter with %d beats' % beats)
+    return (levels + division + [2, 2, 2])[:3]
+
+def beat_strength(onset, meters):
+    """ returns the beat strength of an onset, given the meters as collected
+    by parse_kern, following music21's beatStrength for notes of a flat
+    stream """
+    meter_offset, bar, levels = [m for m in meters if m[0] <= onset][-1]
+    if onset + meter_offset < bar:
+        position = onset
+    else:
+        position = (onset - meter_offset) % bar
+    num_parts = levels[0] * levels[1] * levels[2]
+    part = position * num_parts / bar
+    if part.denominator!=1:
+        # between the parts of the measure: half of the lowest weight
+        return 1.0 / 2**4
+    strides = [num_parts, levels[1] * levels[2], levels[2], 1]
+    for level, stride in enumerate(strides):
+        if part % stride == 0:
+            return 1.0 / 2**level
+
+def op_frac(value):
+    """ returns a Fraction as a float if it can be represented exactly,
+    like music21 does for offsets and durations """
+    denominator = value.denominator
+    if denominator & (denominator - 1) == 0:
+        return float(value)
+    return value
+
+def parse_duration(token):
+    """ returns the duration of a **kern token in quarter notes """
+    if 'q' in token or 'Q' in token:
+        raise UnsupportedKernError('grace note %s' % token)
+    if '%' in token:
+        raise UnsupportedKernError('rational duration %s' % token)
+    number = re.search(r'\d+', token)
+    if not number:
+        raise UnsupportedKernError('no duration %s' % token)
+    if int(number.group(0))==0:
+        # breve, longa, maxima
+        duration = Fraction(4 * 2**len(number.group(0)))
+    else:
+        duration = Fraction(4, int(number.group(0)))
+    dots = token.count('.')
+    return duration * (2 - Fraction(1, 2**dots))
+
+def pitch_numbers(name, token):
+    """ takes the note name of a **kern token (e.g. 'cc') and the token,
+    returns the midi note number and the diatonic note number """
+    step = STEPS.index(name[0].lower())
+    if name[0].islower():
+        octave = 3 + len(name)
+    else:
+        octave = 4 - len(name)
+    sharps = re.search('#+', token)
+    flats = re.search('-+', token)
+    if sharps:
+        alter = len(sharps.group(0))
+    elif flats:
+        alter = -len(flats.group(0))
+    else:
+        alter = 0
+    midi = (octave + 1) * 12 + PITCH_CLASSES[step] + alter
+    return midi, octave * 7 + step + 1
+
+def compare_with_music21(corpus_path, filenames):
+    """ reads the **kern files with read_kern_features and with music21,
+    returns a list of the differences, with per difference the filename,
+    the feature, and the index and values of the first differing item.
+    Files which read_kern_features does not support are listed
+    with the feature 'unsupported'.
+    """
+    import music_representations as mr
+    differences = []
+    for f in filenames:
+        path = corpus_path + f + ".krn"
+        try:
+            native = read_kern_features(path)
+        except UnsupportedKernError as e:
+            differences.append({'filename': f, 'feature': 'unsupported',
+             'index': None, 'native': str(e), 'music21': None})
+            continue
+        reference = mr.read_features_music21(path)
+        for feature in sorted(reference):
+            values = native[feature]
+            reference_values = reference[feature]
+            if not isinstance(reference_values, list):
+                values = [values]
+                reference_values = [reference_values]
+            elif values is None or len(values)!=len(reference_values):
+                differences.append({'filename': f, 'feature': feature,
+                 'index': None, 'native': values,
+                 'music21': reference_values})
+                continue
+            for i, v in enumerate(values):
+                if v!=reference_values[i]:
+                    differences.append({'filename': f, 'feature': feature,
+                     'index': i, 'native': v,
+                     'music21': reference_values[i]})
+                    break
+    return differences
@@ -15,17 +15,19 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import music21 as mus
 import numpy as np
 from collections import Counter
 import math
-import copy
+import corpus_store as cs
+import kern_reader as kr
 
 def adjust_meter(mel_dict):
     """ takes a dicionary of melodies, calculates the duration shifts per 
     tune family using histogram intersection and returns the dictionary 
-    of melodies after applying meter shift """
-    adjusted_dict = copy.deepcopy(mel_dict)
+    of melodies after applying meter shift.
+    The symbols of shifted melodies are returned as SymbolColumns
+    (cf. transform_symbols) """
+    adjusted_dict = [dict(m) for m in mel_dict]
     durations_of_interest = [0.0625, 0.125, 0.25, 0.5, 1.0, 2.0, 4.0]
     tunefams = set([m['tunefamily_id'] for m in mel_dict])
     for t in tunefams :
@@ -38,17 +40,19 @@ def adjust_meter(mel_dict):
                 hist2 = create_duration_histogram(mel, durations_of_interest)
                 meter_shift = get_meter_shift(hist1, hist2, 
                  durations_of_interest)
-                for s in mel['symbols']:
-                    s['ioi'] *= meter_shift
-                    s['onset'] *= meter_shift
+                mel['symbols'] = transform_symbols(mel['symbols'], 
+                 onset_factor=meter_shift)
             mel['onsets_multiplied_by'] = meter_shift
     return adjusted_dict
 
 def adjust_pitches(mel_dict):
     """ takes a dicionary of melodies, calculates the pitch shifts per 
     tune family using pitch histogram intersection and returns the dictionary 
-    of melodies after applying pitch shift """
-    adjusted_dict = copy.deepcopy(mel_dict)
+    of melodies after applying pitch shift.
+    The symbols of shifted melodies are new lists of symbol dicts, or 
+    SymbolColumns if they are given as SymbolColumns (cf. transform_symbols) 
+    """
+    adjusted_dict = [dict(m) for m in mel_dict]
     tunefams = set([m['tunefamily_id'] for m in mel_dict])
     for t in tunefams:
         melodies = [m for m in adjusted_dict if m['tunefamily_id']==t]
@@ -59,8 +63,8 @@ def adjust_pitches(mel_dict):
             else:
                 hist2 = create_pitch_histogram(mel)
                 pitch_shift = get_pitch_shift(hist1, hist2)
-                for s in mel['symbols']:
-                    s['pitch'] += pitch_shift
+                mel['symbols'] = transform_symbols(mel['symbols'], 
+                 pitch_shift=pitch_shift)
             mel['pitch_shifted_by'] = pitch_shift
     return adjusted_dict
 
@@ -89,7 +93,7 @@ def create_pitch_histogram(melody):
         histogram.append({"pitch12": s, "value": hist_weight})
     return histogram
 
-def extract_melodies_from_corpus(corpus_path, meta_dict):
+def extract_melodies_from_corpus(corpus_path, meta_dict, native_reader=True):
     """ takes a corpus path, 
     and a dictionary with metadata about the corpus
     returns a dictionary with per melody:
@@ -106,81 +110,87 @@ def extract_melodies_from_corpus(corpus_path, meta_dict):
         - phrase position of note
         - scale degree of note
         - note index
+    If native_reader is True, the **kern files are read by kern_reader,
+    and only files it cannot handle are parsed with music21.
     """
     # loop through phrases per song, make dict
     mel_dict = []
     melodies = set([a['filename'] for a in meta_dict])
     for m in melodies:
-        pitch_hist = []
-        symbols = []
-        phrase_ends = []
-        melody = mus.converter.parse(corpus_path + m + ".krn")
-        mel = melody.flat
-        this_key = mel.getElementsByClass(mus.key.Key)
-        if not this_key:
-            key_shift = None
-        else:
-            key_shift = this_key[0].tonic.diatonicNoteNum
-        # get fermatas in the melody, indicating phrase endings
-        for item in mel.notesAndRests:
-            if item.expressions:
-                phrase_ends.append(item.offset)
-        total_duration = mel.duration.quarterLength
-        tune = mel.stripTies().notes
-        # pitches, pitch intervals, scale degrees
-        pitches = [t.pitch.midi for t in tune]
-        pInt = [pitches[i] - pitches[i-1] 
-         for i,p in enumerate(pitches) if i > 0]
-        if key_shift:
-            sd = [(t.diatonicNoteNum - key_shift)%7 + 1 for t in tune]
-        else:
-            sd = [None for t in tune]
-        # onsets, iois, ioiR
-        onsets = [t.offset for t in tune]
-        iois = [onsets[i+1] - onsets[i] for i,o in enumerate(onsets) if 
-         i < len(onsets) - 1]
-        iois.append(tune[-1].quarterLength)
-        ioiR = [iois[i]/iois[i-1] for i,o in enumerate(iois) if i > 0]
-        #### metric accent #####
-        if len(melody.parts[0].getElementsByClass(mus.stream.Measure))==1:
-            # only one measure, hence no meter
-            metric_weights = [np.nan for a in mel]  
-        else:
-            metric_weights = [a.beatStrength for a in mel]
-        #### initialize phrase number #####
-        phrase_num = 0
-        for j in range(len(tune)):
-            if j==0 :
-                symbols.append({'pitch':pitches[j],'pitch_interval':None,
-                'onset':onsets[j],'ioi':iois[j],'ioiR':None, 'phrase_id':0,
-                'scale_degree':sd[j],
-                'metric_weight':metric_weights[j],
-                'note_index':j
-                })
-            else :
-                if len(phrase_ends) > phrase_num:
-                    if onsets[j] > phrase_ends[phrase_num]:
-                        phrase_num += 1
-                symbols.append({'pitch': pitches[j],
-                'pitch_interval': pInt[j-1],
-                'onset': onsets[j],'ioi': iois[j],'ioiR': ioiR[j-1],
-                'phrase_id': phrase_num,
-                'scale_degree': sd[j],
-                'metric_weight':metric_weights[j],
-                'note_index': j
-                })
-        # calculate phrase positions
-        phrase_nums = set([s['phrase_id'] for s in symbols])
-        for p in phrase_nums :
-            phr_subset = [s for s in symbols if s['phrase_id']==p]
-            phr_length = len(phr_subset)
-            for i,s in enumerate(phr_subset) :
-                s['phrasePosition'] = (i+1)/float(phr_length)
+        path = corpus_path + m + ".krn"
+        features = None
+        if native_reader:
+            try:
+                features = kr.read_kern_features(path)
+            except kr.UnsupportedKernError:
+                # e.g. several voices or grace notes: music21 takes over
+                features = None
+        if features is None:
+            features = read_features_music21(path)
+        symbols = features_to_symbols(features)
         tunefamily_id = next((info['tunefamily_id'] for info in meta_dict if 
          info['filename']==m),None)
         mel_dict.append({'tunefamily_id':tunefamily_id, 
             'filename':m,'symbols':symbols})
     return mel_dict
+
+def features_to_symbols(features):
+    """ takes the features of a melody, as returned by read_features_music21 
+    or kern_reader.read_kern_features, and returns the list of symbols
+    used by extract_melodies_from_corpus """
+    symbols = []
+    phrase_ends = features['phrase_ends']
+    key_shift = features['tonic']
+    # pitches, pitch intervals, scale degrees
+    pitches = features['pitches']
+    pInt = [pitches[i] - pitches[i-1] 
+     for i,p in enumerate(pitches) if i > 0]
+    if key_shift:
+        sd = [(d - key_shift)%7 + 1 for d in features['diatonic_note_nums']]
+    else:
+        sd = [None for p in pitches]
+    # onsets, iois, ioiR
+    onsets = features['onsets']
+    iois = [onsets[i+1] - onsets[i] for i,o in enumerate(onsets) if 
+     i < len(onsets) - 1]
+    iois.append(features['last_duration'])
+    ioiR = [iois[i]/iois[i-1] for i,o in enumerate(iois) if i > 0]
+    #### metric accent #####
+    if features['metric_weights'] is None:
+        # only one measure, hence no meter
+        metric_weights = [np.nan for p in pitches]
+    else:
+        metric_weights = features['metric_weights']
+    #### initialize phrase number #####
+    phrase_num = 0
+    for j in range(len(pitches)):
+        if j==0 :
+            symbols.append({'pitch':pitches[j],'pitch_interval':None,
+            'onset':onsets[j],'ioi':iois[j],'ioiR':None, 'phrase_id':0,
+            'scale_degree':sd[j],
+            'metric_weight':metric_weights[j],
+            'note_index':j
+            })
+        else :
+            if len(phrase_ends) > phrase_num:
+                if onsets[j] > phrase_ends[phrase_num]:
+                    phrase_num += 1
+            symbols.append({'pitch': pitches[j],
+            'pitch_interval': pInt[j-1],
+            'onset': onsets[j],'ioi': iois[j],'ioiR': ioiR[j-1],
+            'phrase_id': phrase_num,
+            'scale_degree': sd[j],
+            'metric_weight':metric_weights[j],
+            'note_index': j
+            })
+    # calculate phrase positions
+    phrase_nums = set([s['phrase_id'] for s in symbols])
+    for p in phrase_nums :
+        phr_subset = [s for s in symbols if s['phrase_id']==p]
+        phr_length = len(phr_subset)
+        for i,s in enumerate(phr_subset) :
+            s['phrasePosition'] = (i+1)/float(phr_length)
+    return symbols
     
 def filter_phrases(mel_dict):
     """ this function takes a dictionary of melodies, and returns a dictionary 
@@ -205,7 +215,7 @@ def get_meter_shift(hist1, hist2, durations_of_interest):
     vecsize = len(durations_of_interest)    
     h1 = np.array([hist1[k] for k in sorted(hist1.keys())])
     h2 = np.array([hist2[k] for k in sorted(hist2.keys())])
-    h1 = np.lib.pad(h1, (vecsize,vecsize), 'constant', constant_values=(0,0))
+    h1 = np.pad(h1, (vecsize,vecsize), 'constant', constant_values=(0,0))
     max_int = -vecsize
     shift = 0
     for k in range(2*vecsize):
@@ -225,7 +235,7 @@ def get_pitch_shift(hist1, hist2):
 		h1[i['pitch12']] = i['value']
 	for i in hist2:
 		h2[i['pitch12']] = i['value']
-	h1 = np.lib.pad(h1, (120,120), 'constant', constant_values=(0,0))
+	h1 = np.pad(h1, (120,120), 'constant', constant_values=(0,0))
 	max_int = -120
 	shift = 0
 	for k in range(240):
@@ -239,39 +249,113 @@ def hand_adjust_melodies(mel_dict, hand_adjust_dict):
     """ takes a list of melodies and a hand_adjust_dict which lists for each 
     melody how its durations and pitches should be altered so that they 
     match within a tune family. Adjusts the melodies accordingly.
+    The symbols of the adjusted melodies are SymbolColumns 
+    (cf. transform_symbols).
     """
-    adjusted_dict = copy.deepcopy(mel_dict)
+    adjusted_dict = [dict(m) for m in mel_dict]
     for m in adjusted_dict:
         relevant_item = next((h for h in hand_adjust_dict if 
          h['filename']==m['filename']),None)
         meter_shift = float(relevant_item['time_stretch'])
         pitch_shift = int(relevant_item['pitch_shift'])
-        for s in m['symbols']:
-            s['pitch'] += pitch_shift
-            s['onset'] /= meter_shift
-            s['ioi'] /= meter_shift
+        m['symbols'] = transform_symbols(m['symbols'], 
+         onset_divisor=meter_shift, pitch_shift=pitch_shift)
         m['onsets_multiplied_by'] = 1.0/meter_shift
         m['pitch_shifted_by'] = pitch_shift
     return adjusted_dict
     
+def iter_duration_weighted_pitch_sequences(mel_dict, sampling_rate):
+    """ takes a dictionary of melodies or phrases and a sampling rate 
+    (samples per quarter note), and generates the duration weighted pitch 
+    sequence of one melody at a time. Every pitch is repeated 
+    round(ioi * sampling_rate) times; the symbols of the sequences are 
+    SymbolColumns with only a pitch column.
+    """
+    for m in mel_dict:
+        symbols = m['symbols']
+        if isinstance(symbols, cs.SymbolColumns):
+            pitches = symbols.column('pitch')
+            iois = symbols.column('ioi')
+        else:
+            pitches = np.array([s['pitch'] for s in symbols])
+            iois = np.array([float(s['ioi']) for s in symbols])
+        repeats = np.rint(iois * sampling_rate).astype(int)
+        pitch_sequence = np.repeat(pitches, repeats)
+        dict_entry = {'filename': m['filename'],
+         'tunefamily_id': m['tunefamily_id'],
+         'symbols': cs.SymbolColumns({'pitch': pitch_sequence}, 
+          integer_columns=['pitch'])}
+        for key in ('onsets_multiplied_by', 'pitch_shifted_by', 'segment_id'):
+            if key in m:
+                dict_entry[key] = m[key]
+        yield dict_entry
+
 def make_duration_weighted_pitch_sequences(mel_dict, sampling_rate):
     """this function takes a dictionary of melodies or phrases 
     and an indication how often 
     per quarter note a melody is to be sampled (sampling_rate)
     returns duration weighted pitch sequences
+    (cf. iter_duration_weighted_pitch_sequences)
     """
-    mel_dict_dw = []
-    for m in mel_dict:
-        pitch_sequence = []
-        for s in m['symbols'] :
-            repeat = int(round(s['ioi']*sampling_rate))
-            pitch_sequence.extend([s['pitch']]*repeat)
-        dict_entry = {'filename': m['filename'],
-         'tunefamily_id': m['tunefamily_id'],
-         'symbols': [{'pitch': p} for p in pitch_sequence]}
-        if 'onsets_multiplied_by' in m:
-            dict_entry['onsets_multiplied_by'] = m['onsets_multiplied_by']
-        if 'segment_id' in m:
-            dict_entry['segment_id'] = m['segment_id']
-        mel_dict_dw.append(dict_entry)
-    return mel_dict_dw
\ No newline at end of file
+    return list(iter_duration_weighted_pitch_sequences(mel_dict, 
+     sampling_rate))
+
+def read_features_music21(path):
+    """ parses a **kern file with music21, returns the features of the melody 
+    which features_to_symbols needs:
+    midi note numbers, diatonic note numbers, diatonic note number of the 
+    tonic, onsets, duration of the last note, onsets of notes with fermatas 
+    and metric weights (None if the melody has only one measure)
+    """
+    # music21 is slow to import: only import it when it is needed
+    import music21 as mus
+    melody = mus.converter.parse(path)
+    mel = melody.flat
+    this_key = mel.getElementsByClass(mus.key.Key)
+    if not this_key:
+        key_shift = None
+    else:
+        key_shift = this_key[0].tonic.diatonicNoteNum
+    # get fermatas in the melody, indicating phrase endings
+    phrase_ends = [item.offset for item in mel.notesAndRests 
+     if item.expressions]
+    tune = mel.stripTies().notes
+    if len(melody.parts[0].getElementsByClass(mus.stream.Measure))==1:
+        metric_weights = None
+    else:
+        metric_weights = [t.beatStrength for t in tune]
+    return {'pitches': [t.pitch.midi for t in tune],
+     'diatonic_note_nums': [t.pitch.diatonicNoteNum for t in tune],
+     'tonic': key_shift,
+     'onsets': [t.offset for t in tune],
+     'last_duration': tune[-1].quarterLength,
+     'phrase_ends': phrase_ends,
+     'metric_weights': metric_weights}
+
+def transform_symbols(symbols, onset_factor=None, pitch_shift=0, 
+ onset_divisor=None):
+    """ returns the symbols of a melody or segment as SymbolColumns, 
+    with onsets and iois multiplied by onset_factor and/or divided by 
+    onset_divisor, and pitches shifted by pitch_shift. 
+    The other columns are shared with the given symbols.
+    Onsets and iois of SymbolColumns are floats: if only the pitches of a 
+    list of symbol dicts are shifted, a list of symbol dicts is returned, 
+    which keeps onsets and iois such as Fraction(1, 3) unchanged.
+    """
+    if onset_factor is None and onset_divisor is None:
+        if not pitch_shift:
+            return symbols
+        if not isinstance(symbols, cs.SymbolColumns):
+            return [dict(s, pitch=s['pitch'] + pitch_shift) for s in symbols]
+    symbols = cs.as_symbol_columns(symbols)
+    columns = dict(symbols.columns)
+    for c in ('onset', 'ioi'):
+        if c in columns:
+            if onset_factor is not None:
+                columns[c] = columns[c] * onset_factor
+            if onset_divisor is not None:
+                columns[c] = columns[c] / onset_divisor
+    if 'pitch' in columns:
+        columns['pitch'] = columns['pitch'] + pitch_shift
+    return cs.SymbolColumns(columns, symbols.integer_columns, 
+     symbols.nullable_columns)
@@ -0,0 +1,106 @@
+"""
+    Copyright 2015, Berit Janssen.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import corpus_store as cs
+import music_representations as mr
+
+MAX_INTERVAL = 12
+MAX_LOG_IOI_RATIO = 3
+
+def embed(item, weights=(1.0, 1.0, 1.0)):
+    """ takes a melody or segment, returns a vector of fixed size:
+    its duration weighted pitch histogram (over midi note numbers),
+    its pitch interval histogram (intervals up to an octave) and its
+    ioi ratio profile (histogram of log2 ioi ratios, rounded),
+    each normalized and multiplied by its weight """
+    symbols = cs.as_symbol_columns(item['symbols'])
+    pitches = symbols.curve('pitch')
+    pitch_hist = np.zeros(128)
+    if 'ioi' in symbols[0]:
+        for h in mr.create_pitch_histogram(item):
+            pitch_hist[int(h['pitch12'])] = h['value']
+    else:
+        # e.g. duration weighted pitch sequences: every sample counts once
+        np.add.at(pitch_hist, np.array(pitches, dtype=int), 1.0)
+    interval_hist = np.zeros(2 * MAX_INTERVAL + 1)
+    intervals = np.clip(np.diff(pitches), -MAX_INTERVAL, MAX_INTERVAL)
+    np.add.at(interval_hist, intervals.astype(int) + MAX_INTERVAL, 1.0)
+    ioi_profile = np.zeros(2 * MAX_LOG_IOI_RATIO + 1)
+    if 'ioiR' in symbols[0]:
+        ratios = [r for r in symbols.curve('ioiR') if r]
+        if ratios:
+            log_ratios = np.clip(np.round(np.log2(ratios)),
+             -MAX_LOG_IOI_RATIO, MAX_LOG_IOI_RATIO)
+            np.add.at(ioi_profile, log_ratios.astype(int) +
+             MAX_LOG_IOI_RATIO, 1.0)
+    parts = []
+    for hist, weight in zip((pitch_hist, interval_hist, ioi_profile),
+     weights):
+        total = hist.sum()
+        parts.append(weight * hist / total if total else hist)
+    return np.concatenate(parts)
+
+def nearest_melodies(segment_list, melody_list, k, weights=(1.0, 1.0, 1.0)):
+    """ takes a list of segments and a list of melodies, returns per segment
+    the k melodies whose embeddings (cf. embed) are closest to that of the
+    segment in euclidean distance, in the order of melody_list.
+    Only the other melodies are ranked: the melody the segment is taken
+    from is always returned, in addition to the k nearest """
+    seg_vectors = np.array([embed(s, weights) for s in segment_list])
+    mel_vectors = np.array([embed(m, weights) for m in melody_list])
+    # squared euclidean distances of all segments to all melodies
+    distances = ((seg_vectors**2).sum(axis=1)[:, np.newaxis] +
+     (mel_vectors**2).sum(axis=1)[np.newaxis, :] -
+     2 * np.dot(seg_vectors, mel_vectors.T))
+    mel_filenames = np.array([m['filename'] for m in melody_list])
+    candidate_lists = []
+    for s, seg_distances in zip(segment_list, distances):
+        own = mel_filenames==s['filename']
+        others = np.flatnonzero(~own)
+        if k < len(others):
+            nearest = np.argpartition(seg_distances[others], k - 1)[:k]
+            others = others[nearest]
+        keep = np.sort(np.concatenate((np.flatnonzero(own), others)))
+        candidate_lists.append([melody_list[i] for i in keep])
+    return candidate_lists
+
+def prefilter_recall(exhaustive_results, filtered_results, sim_measure,
+ greater_or_lower):
+    """ takes the results of matches_in_corpus without and with prefilter,
+    and returns the proportion of queries for which the best matching
+    melody (other than the query's own melody) was kept by the prefilter.
+    greater_or_lower indicates whether higher (operator.gt) or lower
+    (operator.lt) similarity values are better, as in
+    evaluate.filter_results """
+    best = {}
+    for r in exhaustive_results:
+        if r['query_filename']==r['match_filename']:
+            continue
+        query = (r['query_filename'], r['query_segment_id'])
+        similarity = r['matches'][sim_measure][0]['similarity']
+        if query not in best or greater_or_lower(similarity, best[query][0]):
+            best[query] = (similarity, set([r['match_filename']]))
+        elif similarity==best[query][0]:
+            best[query][1].add(r['match_filename'])
+    kept = set([(r['query_filename'], r['query_segment_id'],
+     r['match_filename']) for r in filtered_results])
+    if not best:
+        return 1.0
+    found = [q for q in best if any((q[0], q[1], m) in kept for
+     m in best[q][1])]
+    return len(found) / float(len(best))
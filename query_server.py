@@ -0,0 +1,300 @@
+"""
+    Copyright 2015, Berit Janssen.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import pickle
+import signal
+import socket
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+
+import find_matches as fm
+
+MEASURES = {'distance_measures': fm.distance_measures,
+ 'local_aligner': fm.local_aligner,
+ 'SIAM': fm.SIAM}
+
+# the corpus index of a worker process, set once by init_worker
+_worker_index = None
+
+class CorpusIndex(object):
+    """ holds the melodies of a corpus per tune family, and its segments
+    per (filename, segment_id), so that queries do not need to
+    search through the corpus """
+    def __init__(self, melody_list, segment_list):
+        self.melodies = {}
+        for m in melody_list:
+            self.melodies.setdefault(m['tunefamily_id'], []).append(m)
+        self.segments = {(s['filename'], s['segment_id']): s for
+         s in segment_list}
+
+    def segment(self, query):
+        """ returns the segment a query refers to: either a segment
+        passed with the query, or a segment of the corpus,
+        given by filename and segment_id """
+        if 'segment' in query:
+            return query['segment']
+        return self.segments[(query['filename'], query['segment_id'])]
+
+def init_worker(melody_list, segment_list):
+    """ called once in every worker process: index the corpus """
+    global _worker_index
+    _worker_index = CorpusIndex(melody_list, segment_list)
+
+def init_worker_from_store(path):
+    """ called once in every worker process: index the corpus in a
+    corpus store, whose pages are shared by all workers """
+    import corpus_store as cs
+    store = cs.open_store(path)
+    init_worker(store.melodies(), store.segments())
+
+def run_batch(measure_name, tunefamily_id, music_representation,
+ return_positions, scaling, args, segment_list):
+    """ runs one measure for a batch of segments against the melodies
+    of one tune family, in a worker process """
+    melody_list = _worker_index.melodies.get(tunefamily_id, [])
+    return MEASURES[measure_name](melody_list, segment_list,
+     music_representation, return_positions, scaling, *args)
+
+def load_corpus(corpus_path, meta_path):
+    """ reads the melodies of a corpus, given the path to the **kern files
+    and the path to a csv with the filenames and tune family ids,
+    and returns the melodies and their phrases """
+    import input_output as io
+    import music_representations as mr
+    meta_dict = io.csv_to_dict(meta_path)
+    melody_list = mr.extract_melodies_from_corpus(corpus_path, meta_dict)
+    return melody_list, mr.filter_phrases(melody_list)
+
+def to_json(item):
+    """ json encoder for numpy values and fractions (e.g. onsets of
+    triplets) in the match dicts """
+    if isinstance(item, Fraction):
+        return float(item)
+    if hasattr(item, 'item'):
+        return item.item()
+    raise TypeError(repr(item))
+
+class QueryService(object):
+    """ serves occurrence queries for a preloaded corpus.
+    Queries arriving within batch_window seconds of each other are batched
+    per tune family and parameters, and run on a pool of worker processes.
+    A query is a json object on one line, with the keys:
+    - id: returned with every response line
+    - filename and segment_id of a segment in the corpus,
+    or segment: a segment dict as produced by filter_phrases
+    - measure: 'local_aligner' (default), 'distance_measures' or 'SIAM'
+    - music_representation (default 'pitch'), return_positions (default true),
+    scaling (default null) and args (default []), as in matches_in_corpus
+    - tunefamily_id: the family to search (default: that of the segment)
+    For each query, the service streams one line per match dict,
+    {"id": ..., "result": {...}}, followed by {"id": ..., "done": true}.
+    If the melodies and segments come from a corpus store,
+    its path can be passed as store_path, so that the workers open the store
+    rather than receiving copies of the corpus.
+    """
+    def __init__(self, melody_list, segment_list, workers=None,
+     batch_window=0.01, max_batch=64, store_path=None):
+        self.index = CorpusIndex(melody_list, segment_list)
+        self.workers = workers or os.cpu_count() or 1
+        if store_path:
+            self.executor = ProcessPoolExecutor(self.workers,
+             initializer=init_worker_from_store, initargs=(store_path,))
+        else:
+            self.executor = ProcessPoolExecutor(self.workers,
+             initializer=init_worker, initargs=(melody_list, segment_list))
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.queue = None
+
+    async def serve(self, host='127.0.0.1', port=8765, path=None):
+        """ serve on a localhost port, or on a unix socket if path is given,
+        until the task is cancelled or the process receives SIGTERM """
+        loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self.batch_queries())
+        try:
+            # the workers are forked before the server listens, so that they
+            # do not inherit its socket or the connections of clients
+            await self.start_workers()
+            if path:
+                server = await asyncio.start_unix_server(self.handle, path)
+            else:
+                server = await asyncio.start_server(self.handle, host, port)
+            serving = asyncio.ensure_future(server.serve_forever())
+            loop.add_signal_handler(signal.SIGTERM, serving.cancel)
+            try:
+                async with server:
+                    await serving
+            except asyncio.CancelledError:
+                if not serving.cancelled():
+                    raise
+            finally:
+                loop.remove_signal_handler(signal.SIGTERM)
+        finally:
+            batcher.cancel()
+            self.executor.shutdown()
+
+    async def start_workers(self):
+        """ starts all worker processes, and waits until they have
+        indexed the corpus """
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, os.getpid)
+         for i in range(self.workers)])
+
+    async def handle(self, reader, writer):
+        """ reads queries from a connection, one per line,
+        and answers them concurrently """
+        lock = asyncio.Lock()
+        tasks = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.strip():
+                tasks.append(asyncio.ensure_future(
+                 self.answer(line, writer, lock)))
+        await asyncio.gather(*tasks)
+        writer.close()
+        await writer.wait_closed()
+
+    async def answer(self, line, writer, lock):
+        query_id = None
+        try:
+            query = json.loads(line)
+            query_id = query.get('id')
+            segment = self.index.segment(query)
+            future = asyncio.get_event_loop().create_future()
+            await self.queue.put((self.batch_key(query, segment),
+             segment, future))
+            results = await future
+            responses = [{'id': query_id, 'result': r} for r in results]
+            responses.append({'id': query_id, 'done': True})
+            lines = [json.dumps(r, default=to_json) for r in responses]
+        except Exception as e:
+            lines = [json.dumps({'id': query_id, 'error': repr(e)})]
+        async with lock:
+            for l in lines:
+                writer.write((l + '\n').encode('utf-8'))
+            await writer.drain()
+
+    def batch_key(self, query, segment):
+        """ queries with the same key can be run as one call
+        of the measure """
+        measure = query.get('measure', 'local_aligner')
+        if measure not in MEASURES:
+            raise ValueError('unknown measure %s' % measure)
+        return (measure,
+         query.get('tunefamily_id', segment['tunefamily_id']),
+         query.get('music_representation', 'pitch'),
+         query.get('return_positions', True),
+         query.get('scaling'),
+         tuple(query.get('args', [])))
+
+    async def batch_queries(self):
+        """ collects the queries arriving within the batch window,
+        groups them by batch key and runs each group on the worker pool """
+        loop = asyncio.get_event_loop()
+        while True:
+            pending = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(pending) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(
+                     self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            groups = {}
+            for key, segment, future in pending:
+                groups.setdefault(key, []).append((segment, future))
+            for key, group in groups.items():
+                asyncio.ensure_future(self.run_group(key, group))
+
+    async def run_group(self, key, group):
+        measure, fam, representation, return_positions, scaling, args = key
+        segment_list = [g[0] for g in group]
+        try:
+            results = await asyncio.get_event_loop().run_in_executor(
+             self.executor, run_batch, measure, fam, representation,
+             return_positions, scaling, args, segment_list)
+        except Exception as e:
+            for segment, future in group:
+                future.set_exception(e)
+            return
+        # every measure returns one result per segment and melody,
+        # segment by segment
+        per_segment = len(results) // len(group) if group else 0
+        for i, (segment, future) in enumerate(group):
+            future.set_result(results[i * per_segment:(i + 1) * per_segment])
+
+def query_service(query, host='127.0.0.1', port=8765, path=None):
+    """ sends one query to a running service and yields the match dicts """
+    if path:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+    else:
+        sock = socket.create_connection((host, port))
+    with sock, sock.makefile('rw', encoding='utf-8') as f:
+        f.write(json.dumps(query, default=to_json) + '\n')
+        f.flush()
+        sock.shutdown(socket.SHUT_WR)
+        for line in f:
+            response = json.loads(line)
+            if 'error' in response:
+                raise RuntimeError(response['error'])
+            if response.get('done'):
+                break
+            yield response['result']
+        else:
+            raise RuntimeError('connection closed before the query was done')
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve occurrence queries '
+     'for a corpus that is loaded once.')
+    parser.add_argument('--corpus', help='path to the **kern files')
+    parser.add_argument('--meta', help='csv with filename and tunefamily_id')
+    parser.add_argument('--pickle', help='pickle of (melodies, segments), '
+     'instead of --corpus and --meta')
+    parser.add_argument('--store', help='corpus store, as written by '
+     'corpus_store.write_corpus_store, instead of --corpus and --meta')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', help='serve on this unix socket')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--batch-window', type=float, default=0.01)
+    options = parser.parse_args()
+    if options.store:
+        import corpus_store as cs
+        store = cs.CorpusStore(options.store)
+        melody_list, segment_list = store.melodies(), store.segments()
+    elif options.pickle:
+        with open(options.pickle, 'rb') as f:
+            melody_list, segment_list = pickle.load(f)
+    else:
+        melody_list, segment_list = load_corpus(options.corpus, options.meta)
+    service = QueryService(melody_list, segment_list, options.workers,
+     options.batch_window, store_path=options.store)
+    asyncio.run(service.serve(options.host, options.port, options.socket))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""
+    Copyright 2015, Berit Janssen.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import corpus_store as cs
+import find_matches as fm
+
+# measures which slide the segment over the melody
+SLIDING_MEASURES = (fm.distance_measures, fm.best_match_distances)
+
+def pair_cost(segment, melody, measure):
+    """ estimates the work of comparing a segment to a melody:
+    the number of compared values of all windows for sliding distance
+    measures, the size of the dynamic programming matrix for local
+    alignment, and the number of translation vectors for SIAM """
+    seg_length = len(segment['symbols'])
+    mel_length = len(melody['symbols'])
+    if measure in SLIDING_MEASURES:
+        windows = max(mel_length - seg_length + 1, 1)
+        return windows * min(seg_length, mel_length)
+    return seg_length * mel_length
+
+def make_chunks(all_melody_list, all_segment_list, measure, num_chunks):
+    """ splits the comparisons of matches_in_corpus into chunks of
+    (segment, melody) pairs of one tune family, of roughly equal estimated
+    cost: families which cost more than the total cost / num_chunks are
+    split into consecutive runs of pairs. Returns the chunks as dicts with
+    the position of their first pair in the canonical order of results,
+    their cost and their pairs, grouped per segment """
+    families = []
+    tune_fams = sorted(set([m['tunefamily_id'] for m in all_melody_list]))
+    for fam in tune_fams:
+        segment_list = [s for s in all_segment_list if s['tunefamily_id']==fam]
+        melody_list = [m for m in all_melody_list if m['tunefamily_id']==fam]
+        # pairs in the order in which the measures return results
+        families.append([(s, m, pair_cost(s, m, measure)) for
+         s in segment_list for m in melody_list])
+    total_cost = sum([p[2] for pairs in families for p in pairs])
+    target_cost = total_cost / float(max(num_chunks, 1))
+    chunks = []
+    for f, pairs in enumerate(families):
+        start = 0
+        cost = 0
+        for i, pair in enumerate(pairs):
+            cost += pair[2]
+            if cost >= target_cost or i==len(pairs) - 1:
+                chunks.append({'position': (f, start), 'cost': cost,
+                 'groups': group_by_segment(pairs[start:i + 1])})
+                start = i + 1
+                cost = 0
+    return chunks
+
+def group_by_segment(pairs):
+    """ groups consecutive pairs with the same segment:
+    returns a list of (segment, melody_list) """
+    groups = []
+    for segment, melody, cost in pairs:
+        if groups and groups[-1][0] is segment:
+            groups[-1][1].append(melody)
+        else:
+            groups.append((segment, [melody]))
+    return groups
+
+def to_references(groups, references):
+    """ replaces the symbols of melodies and segments of a corpus store
+    in the groups of a chunk by their source in the store (cf.
+    corpus_store.SymbolColumns), so that they are not pickled as copies.
+    references holds the converted items per id, so that each item is
+    converted once """
+    def reference(item):
+        if id(item) not in references:
+            source = getattr(item['symbols'], 'source', None)
+            if source:
+                references[id(item)] = dict(item, symbols=source)
+            else:
+                references[id(item)] = item
+        return references[id(item)]
+    return [(reference(segment), [reference(m) for m in melody_list])
+     for segment, melody_list in groups]
+
+def from_references(groups):
+    """ opens the symbols given by their source in the store,
+    in a worker process """
+    items = {}
+    def resolve(item):
+        if id(item) not in items:
+            if isinstance(item['symbols'], tuple):
+                path, start, stop = item['symbols']
+                items[id(item)] = dict(item,
+                 symbols=cs.open_store(path).symbols(start, stop))
+            else:
+                items[id(item)] = item
+        return items[id(item)]
+    return [(resolve(segment), [resolve(m) for m in melody_list])
+     for segment, melody_list in groups]
+
+def run_chunk(groups, music_representation, measure, return_positions,
+ scaling, args):
+    """ runs the measure for the pairs of one chunk, in a worker process """
+    results = []
+    for segment, melody_list in from_references(groups):
+        results.extend(measure(melody_list, [segment], music_representation,
+         return_positions, scaling, *args))
+    return results
+
+def parallel_matches_in_corpus(all_melody_list, all_segment_list,
+ music_representation='pitch', measure=fm.local_aligner,
+ return_positions=True, scaling=None, *args, workers=None,
+ chunks_per_worker=4):
+    """ finds occurrences in a corpus like find_matches.matches_in_corpus,
+    and returns the results in the same order, but runs the comparisons on
+    a pool of worker processes. The comparisons are split into chunks of
+    roughly equal estimated cost (cf. pair_cost), so that large tune
+    families are shared between workers. Chunks are handed out largest
+    first, each to the next worker which is idle. Melodies and segments of
+    a corpus store are sent to the workers as references to their rows,
+    and the workers read them from the store. """
+    tick = time.perf_counter()
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunks = make_chunks(all_melody_list, all_segment_list, measure,
+     workers * chunks_per_worker)
+    chunks.sort(key=lambda c: c['cost'], reverse=True)
+    references = {}
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(run_chunk,
+         to_references(c['groups'], references),
+         music_representation, measure, return_positions, scaling, args)
+         for c in chunks]
+        results = [(c['position'], f.result()) for c, f in
+         zip(chunks, futures)]
+    all_results = []
+    for position, chunk_results in sorted(results, key=lambda r: r[0]):
+        all_results.extend(chunk_results)
+    print(len(chunks), time.perf_counter()-tick)
+    return all_results